@@ -1,12 +1,22 @@
 import streamlit as st
 import requests  # Using direct HTTP requests
-import pypdf
+import httpx  # Async HTTP/2 client for concurrent section calls
+from requests.adapters import HTTPAdapter
+from pdf_extraction import extract_pdf_text, ocr_available, ocr_pdf_text
+from json_stream import IncrementalJSONParser, json_loads
 import os
 import json
+import asyncio
+import hashlib
+import html
+import re
+import threading
+import time
+from collections import OrderedDict
 from dotenv import load_dotenv
 
 # --- CONFIGURATION ---
-# Force reload to ignore old cached keys
+# Re-read .env on every rerun so an edited/rotated key takes effect without a restart
 load_dotenv(override=True)
 
 st.set_page_config(
@@ -17,16 +27,33 @@ st.set_page_config(
 )
 
 # 1. Get API Key securely
-def get_api_key():
-    # Try getting from .env first
-    env_key = os.environ.get("GOOGLE_API_KEY", "").strip()
-    if env_key:
-        return env_key
+class MissingAPIKey(Exception):
+    """Raised inside the cached lookup so a missing key is never memoized."""
+
+# Cached per raw .env value: reruns skip the secrets read and sanitizing,
+# while a changed .env key is a new cache entry
+@st.cache_resource
+def load_api_key(env_key):
+    key = env_key
     
     # Fallback to Streamlit secrets (for cloud deployment)
+    if not key.strip():
+        try:
+            key = st.secrets["GOOGLE_API_KEY"]
+        except:
+            raise MissingAPIKey()
+
+    # Sanitize once: stray quotes/whitespace cause the "Adapter" crash
+    key = key.strip().replace('"', '').replace("'", "")
+    if not key:
+        raise MissingAPIKey()
+    return key
+
+def get_api_key():
+    # Try getting from .env first
     try:
-        return st.secrets["GOOGLE_API_KEY"].strip()
-    except:
+        return load_api_key(os.environ.get("GOOGLE_API_KEY", ""))
+    except MissingAPIKey:
         return None
 
 api_key = get_api_key()
@@ -36,6 +63,9 @@ if not api_key:
     st.stop()
 
 # --- THE LEGAL BRAIN (System Prompt) ---
+# Bump PROMPT_VERSION whenever SYSTEM_PROMPT changes to invalidate cached analyses
+PROMPT_VERSION = "v1"
+
 SYSTEM_PROMPT = """
 You are a Senior Legal Advisor specialized in the Civil Law of Iran (Qanun-e Madani).
 Your task is to analyze the provided contract text (in Farsi) and identify risks based on Iranian law.
@@ -67,132 +97,590 @@ JSON STRUCTURE:
 }
 """
 
+# --- PROMPT CACHE ---
+# Fast/cheap model analyzes every contract; risky ones are re-run on the stronger model
+MODEL_NAME = "gemini-2.5-flash-lite"
+ESCALATION_MODEL_NAME = "gemini-2.5-pro"
+# Escalate unless the triage run finds no HIGH alerts and scores at least this safe.
+# The baseline already ran flash-lite alone, so every escalated upload costs more
+# (a flash-lite call plus a pro call) and takes longer; only clean contracts cost the same.
+ESCALATION_SCORE = 80
+API_ROOT = "https://generativelanguage.googleapis.com/v1beta"
+CACHE_TTL_SECONDS = 3600
+
+def stream_url(model=MODEL_NAME):
+    return f"{API_ROOT}/models/{model}:streamGenerateContent?alt=sse&key={api_key}"
+
+def generate_url(model=MODEL_NAME):
+    return f"{API_ROOT}/models/{model}:generateContent?key={api_key}"
+
+CACHED_CONTENTS_URL = f"{API_ROOT}/cachedContents?key={api_key}"
+
+@st.cache_resource
+def get_session():
+    """One pooled HTTP session per process so TLS/keep-alive survive reruns"""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return session
+
+# Gemini refuses explicit caches below a per-model minimum input size. The
+# current SYSTEM_PROMPT is only a few hundred tokens, so caching is skipped
+# (no request is made) until the prompt grows past these limits.
+MIN_CACHE_TOKENS = {
+    "gemini-2.5-flash-lite": 1024,
+    "gemini-2.5-pro": 4096
+}
+# Deliberately low chars/token so the estimate errs towards trying the cache
+PROMPT_CHARS_PER_TOKEN = 3
+PROMPT_CACHE_TIMEOUT = 10
+
+class PromptCacheUnavailable(Exception):
+    """Transient failure creating the prompt cache; raised so it is not memoized."""
+
+@st.cache_resource(ttl=CACHE_TTL_SECONDS - 60)
+def create_prompt_cache(model):
+    """
+    Uploads SYSTEM_PROMPT once per model as Gemini cached content so each
+    request only sends the contract text. Returns the cache name, or None if
+    the API permanently refuses (e.g. prompt below the minimum cacheable size).
+    """
+    payload = {
+        "model": f"models/{model}",
+        "systemInstruction": {"parts": [{"text": SYSTEM_PROMPT}]},
+        "ttl": f"{CACHE_TTL_SECONDS}s"
+    }
+    try:
+        response = get_session().post(
+            CACHED_CONTENTS_URL,
+            headers={"Content-Type": "application/json"},
+            json=payload,
+            timeout=PROMPT_CACHE_TIMEOUT
+        )
+    except requests.RequestException as e:
+        raise PromptCacheUnavailable(str(e))
+    if response.status_code == 200:
+        return json_loads(response.content).get("name")
+    if 400 <= response.status_code < 500 and response.status_code != 429:
+        return None
+    raise PromptCacheUnavailable(f"HTTP {response.status_code}")
+
+def get_prompt_cache(model=MODEL_NAME):
+    """Cache name for SYSTEM_PROMPT on this model, or None to inline the prompt"""
+    if len(SYSTEM_PROMPT) / PROMPT_CHARS_PER_TOKEN < MIN_CACHE_TOKENS.get(model, 0):
+        return None
+    try:
+        return create_prompt_cache(model)
+    except PromptCacheUnavailable:
+        # Retried on the next analysis instead of being remembered for an hour
+        return None
+
 # --- HELPER FUNCTIONS ---
-def extract_text(uploaded_file):
-    """Smart function to handle both PDF and Text files"""
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+def hash_upload(f, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Returns the sha256 hexdigest of the upload, read in fixed-size chunks,
+    and rewinds it. Streamlit's UploadedFile is already an in-memory BytesIO,
+    so text is extracted from it directly rather than from another copy.
+    """
+    hasher = hashlib.sha256()
+    f.seek(0)
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        hasher.update(chunk)
+    f.seek(0)
+    return hasher.hexdigest()
+
+# Whitespace cleanup (every token is billed). ZWNJ is part of Farsi spelling
+# (e.g. "می‌شود"), so it is kept; only repeated ZWNJs or ones touching a space collapse.
+# Zero-width space, ZWJ, LRM/RLM direction marks (common in RTL PDF extraction) and BOM
+ZERO_WIDTH = re.compile("[\u200b\u200d\u200e\u200f\ufeff]")
+STRAY_ZWNJ = re.compile("[ \t\u00a0]*\u200c[ \t\u00a0\u200c]*")
+INLINE_SPACE = re.compile("[ \t\u00a0]+")
+LINE_EDGE_SPACE = re.compile(" ?\n ?")
+EXTRA_NEWLINES = re.compile("\n{3,}")
+
+def normalize_whitespace(text):
+    """Collapses the repeated spaces, zero-width characters and blank lines PDFs emit"""
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = ZERO_WIDTH.sub("", text)
+    text = STRAY_ZWNJ.sub(lambda m: " " if m.group().strip("\u200c") else "\u200c", text)
+    text = INLINE_SPACE.sub(" ", text)
+    text = LINE_EDGE_SPACE.sub("\n", text)
+    return EXTRA_NEWLINES.sub("\n\n", text).strip()
+
+def extract_text(filename, stream):
+    """Smart function to handle both PDF and Text files (whitespace-normalized)"""
     try:
-        if uploaded_file.name.endswith('.pdf'):
-            reader = pypdf.PdfReader(uploaded_file)
-            text = ""
-            for page in reader.pages:
-                text += page.extract_text() + "\n"
-            return text
-        elif uploaded_file.name.endswith('.txt'):
-            return str(uploaded_file.read(), "utf-8")
+        if filename.endswith('.pdf'):
+            return normalize_whitespace(extract_pdf_text(stream))
+        elif filename.endswith('.txt'):
+            return normalize_whitespace(stream.read().decode("utf-8"))
         else:
             return "فرمت فایل پشتیبانی نمی‌شود."
     except Exception as e:
         return f"Error reading file: {e}"
 
-def analyze_contract(text):
+def to_html(value):
+    """Escapes model text for an HTML block; blank lines would end the block, so newlines become <br>"""
+    return html.escape(str(value)).replace("\r\n", "\n").replace("\n", "<br>")
+
+def render_alerts_html(alerts):
+    """Builds all alerts as collapsible <details> blocks (model output is HTML-escaped)"""
+    blocks = []
+    for alert in alerts:
+        icon = "⛔" if alert.get('severity') == "HIGH" else "⚠️"
+        explanation = str(alert.get('risk_explanation') or '')
+        blocks.append(
+            f"<details open><summary>{icon} {to_html(explanation[:60])}...</summary>"
+            f'<div style="display:flex;gap:1rem">'
+            f'<div style="flex:2">'
+            f"<p><b>بند:</b> <code>{to_html(alert.get('clause_text'))}</code></p>"
+            f"<p><b>تحلیل:</b> {to_html(explanation)}</p>"
+            f"</div>"
+            f'<div style="flex:1">'
+            f"<p><b>اصطلاح:</b> <code>{to_html(alert.get('legal_term'))}</code></p>"
+            f"<p>💡 <b>پیشنهاد:</b> {to_html(alert.get('suggestion'))}</p>"
+            f"</div>"
+            f"</div></details>"
+        )
+    return "\n".join(blocks)
+
+class AnalysisError(Exception):
+    """Raised when Gemini returns an unusable response."""
+
+HEADERS = {
+    "Content-Type": "application/json"
+}
+# (connect, read) seconds; for a stream the read timeout is the longest gap between chunks
+STREAM_TIMEOUT = (10, 120)
+
+# Static pieces of the request body, JSON-encoded once instead of re-encoding
+# SYSTEM_PROMPT on every call. ensure_ascii=False keeps Farsi as raw UTF-8
+# (2 bytes/char) rather than 6-byte \uXXXX escapes.
+BODY_HEAD = b'{"contents":[{"parts":[{"text":'
+BODY_TAIL = b'}]}],"generationConfig":{"response_mime_type":"application/json"}}'
+
+def encode_json_string(text):
+    return json.dumps(text, ensure_ascii=False).encode("utf-8")
+
+# cache_resource, not lru_cache: Streamlit re-executes this script on every rerun
+@st.cache_resource
+def prompt_prefix(system_prompt):
+    """Body bytes up to and including the system prompt, leaving the JSON string open"""
+    return BODY_HEAD + encode_json_string(f"{system_prompt}\n\n")[:-1]
+
+def build_body(contents_text, system_prompt=SYSTEM_PROMPT, model=MODEL_NAME):
+    """Builds the generateContent request body (bytes) for one prompt"""
+    # If the system prompt is cached server-side, reference it instead of inlining it
+    cache_name = get_prompt_cache(model) if system_prompt is SYSTEM_PROMPT else None
+    if cache_name:
+        return (
+            b'{"cachedContent":' + encode_json_string(cache_name) + b',' + BODY_HEAD[1:]
+            + encode_json_string(contents_text) + BODY_TAIL
+        )
+    # Close the open prompt string by appending the contract text without its opening quote
+    return prompt_prefix(system_prompt) + encode_json_string(contents_text)[1:] + BODY_TAIL
+
+def parse_model_output(parser):
+    """Turns the text collected by the parser into the analysis dict"""
+    if not parser.buffer:
+        raise AnalysisError("No candidates returned from API.")
+
+    # Fast path for clean output; otherwise use the object the parser already delimited
+    # (handles code fences or stray prose the model added despite instructions)
+    try:
+        return json_loads(parser.buffer)
+    except ValueError:
+        pass
+    try:
+        return parser.result()
+    except ValueError as e:
+        raise AnalysisError(f"Could not parse model output as JSON: {e}")
+
+def stream_generate(contents_text, system_prompt=SYSTEM_PROMPT, on_field=None, on_item=None, model=MODEL_NAME):
     """
-    UPDATED: Uses direct REST API call to Gemini
-    Fixed: Uses the 'lite' model and sanitizes URL to prevent 'No Connection Adapter' errors.
+    UPDATED: Uses direct REST API call to Gemini ('lite' model unless another is given)
+    Streams the response over SSE so fields can be rendered as soon as they complete.
+    Raises AnalysisError instead of returning None so failures are never cached.
     """
-    # 1. HARDCODED BASE URL (The one you confirmed works)
-    base_url = "[https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-lite:generateContent](https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-lite:generateContent)"
-    
-    # 2. CONSTRUCT URL & SANITIZE
-    # This .replace() chain removes the quotes that cause the "Adapter" crash
-    url = f"{base_url}?key={api_key}".strip().replace('"', '').replace("'", "")
-    
-    headers = {
-        "Content-Type": "application/json"
-    }
-    
-    # Construct the payload
-    payload = {
-        "contents": [{
-            "parts": [{
-                "text": f"{SYSTEM_PROMPT}\n\nCONTRACT TEXT:\n{text}"
-            }]
-        }],
-        "generationConfig": {
-            "response_mime_type": "application/json"
-        }
-    }
+    body = build_body(contents_text, system_prompt, model)
 
-    try:
-        # Make the request
-        response = requests.post(url, headers=headers, json=payload)
-        
-        # Check for HTTP errors (404, 500, etc.)
-        if response.status_code != 200:
-            st.error(f"API Error ({response.status_code}): {response.text}")
-            return None
+    # Make the request
+    response = get_session().post(stream_url(model), headers=HEADERS, data=body, stream=True, timeout=STREAM_TIMEOUT)
+    
+    # Check for HTTP errors (404, 500, etc.)
+    if response.status_code != 200:
+        raise AnalysisError(f"API Error ({response.status_code}): {response.text}")
 
-        # Parse the JSON response
-        result = response.json()
+    # Read the SSE stream: every "data:" line is a partial GenerateContentResponse.
+    # Lines stay raw UTF-8 bytes and go straight to the parser (no decode pass)
+    parser = IncrementalJSONParser(on_field=on_field, on_item=on_item)
+    for line in response.iter_lines():
+        if not line or not line.startswith(b"data:"):
+            continue
+        result = json_loads(line[len(b"data:"):])
         
         # Extract the text from the candidates
         if 'candidates' in result and result['candidates']:
-            raw_text = result['candidates'][0]['content']['parts'][0]['text']
-            
-            # Clean up code fences if the model added them despite instructions
-            clean_json = raw_text.replace("```json", "").replace("```", "").strip()
-            
-            return json.loads(clean_json)
-        else:
-            st.error("No candidates returned from API.")
-            return None
+            parts = result['candidates'][0].get('content', {}).get('parts', [])
+            for part in parts:
+                parser.feed(part.get('text', ''))
+
+    return parse_model_output(parser)
 
+async def generate_async(client, contents_text, system_prompt=SYSTEM_PROMPT):
+    """Non-streaming variant for concurrent calls on a shared httpx.AsyncClient"""
+    response = await client.post(generate_url(), headers=HEADERS, content=build_body(contents_text, system_prompt))
+    if response.status_code != 200:
+        raise AnalysisError(f"API Error ({response.status_code}): {response.text}")
+
+    parser = IncrementalJSONParser()
+    result = json_loads(response.content)
+    if 'candidates' in result and result['candidates']:
+        parts = result['candidates'][0].get('content', {}).get('parts', [])
+        parser.feed("".join(part.get('text', '') for part in parts))
+    return parse_model_output(parser)
+
+# --- LONG CONTRACTS (map-reduce) ---
+# Gemini 2.5 Flash Lite has a 1M-token window; leave headroom for prompt and output
+LONG_CONTEXT_TOKEN_LIMIT = 800_000
+CHUNK_TOKENS = 60_000
+MAX_PARALLEL_CHUNKS = 4
+# Offline estimate: Farsi text averages roughly 3.5 characters per token
+CHARS_PER_TOKEN = 3.5
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+CHUNK_PROMPT = """
+You are a Senior Legal Advisor specialized in the Civil Law of Iran (Qanun-e Madani).
+You are given ONE SECTION of a longer contract (in Farsi). Identify only the risky clauses in this section.
+Return ONLY a valid JSON object, with all explanations in simple Farsi:
+{
+  "section_summary": "One sentence in Farsi describing this section",
+  "risk_score": Integer between 0-100 (100 is safe) for this section,
+  "critical_alerts": [
+    {
+      "clause_text": "The exact Farsi text from the contract",
+      "risk_explanation": "Why this is dangerous in simple Farsi",
+      "severity": "HIGH" or "MEDIUM",
+      "legal_term": "The legal jargon used",
+      "suggestion": "What to ask for instead"
+    }
+  ]
+}
+"""
+
+MERGE_PROMPT = """
+You are a Senior Legal Advisor specialized in the Civil Law of Iran (Qanun-e Madani).
+You are given section-by-section summaries of ONE long contract (in Farsi), in order.
+Return ONLY a valid JSON object, with all text in simple Farsi:
+{
+  "summary": "A 2-sentence simple story of what this contract is about in Farsi",
+  "contract_type": "Type of contract (e.g., Ejareh, Peymankari)",
+  "parties": ["Name 1", "Name 2"],
+  "duration": "Duration of contract",
+  "missing_clauses": ["List of important clauses that are missing"]
+}
+"""
+
+def estimate_tokens(text):
+    return int(len(text) / CHARS_PER_TOKEN)
+
+def chunk_contract(text, max_tokens=CHUNK_TOKENS):
+    """Packs paragraphs into windows of at most max_tokens (oversized paragraphs are hard-split)"""
+    max_chars = int(max_tokens * CHARS_PER_TOKEN)
+    chunks = []
+    current = []
+    current_len = 0
+    for paragraph in PARAGRAPH_BREAK.split(text):
+        if current and current_len + len(paragraph) > max_chars:
+            chunks.append("\n\n".join(current))
+            current = []
+            current_len = 0
+        while len(paragraph) > max_chars:
+            chunks.append(paragraph[:max_chars])
+            paragraph = paragraph[max_chars:]
+        current.append(paragraph)
+        current_len += len(paragraph) + 2
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+def map_reduce_analysis(text, on_item=None):
+    """Analyzes each chunk in parallel, then merges alerts locally and metadata via one more call"""
+    chunks = chunk_contract(text)
+    results = [None] * len(chunks)
+
+    # All sections go out concurrently over one multiplexed HTTP/2 connection;
+    # the semaphore keeps us under Gemini's rate limit. asyncio.run stays on the
+    # script thread, so on_item can safely paint Streamlit elements.
+    async def analyze_section(client, limit, i, chunk):
+        async with limit:
+            prompt = f"CONTRACT SECTION {i + 1}/{len(chunks)}:\n{chunk}"
+            return i, await generate_async(client, prompt, CHUNK_PROMPT)
+
+    async def analyze_sections():
+        limit = asyncio.Semaphore(MAX_PARALLEL_CHUNKS)
+        async with httpx.AsyncClient(http2=True, timeout=120) as client:
+            tasks = [analyze_section(client, limit, i, chunk) for i, chunk in enumerate(chunks)]
+            for next_done in asyncio.as_completed(tasks):
+                i, result = await next_done
+                results[i] = result
+                if on_item:
+                    for alert in result.get('critical_alerts', []):
+                        on_item('critical_alerts', alert)
+
+    asyncio.run(analyze_sections())
+
+    # Union alerts (dropping repeats of the same clause) and average the section scores
+    alerts = []
+    seen_clauses = set()
+    for result in results:
+        for alert in result.get('critical_alerts', []):
+            clause = alert.get('clause_text')
+            if clause in seen_clauses:
+                continue
+            seen_clauses.add(clause)
+            alerts.append(alert)
+    scores = [r['risk_score'] for r in results if isinstance(r.get('risk_score'), (int, float))]
+
+    summaries = "\n".join(
+        f"{i + 1}. {r.get('section_summary', '')}" for i, r in enumerate(results)
+    )
+    analysis = stream_generate(f"SECTION SUMMARIES:\n{summaries}", MERGE_PROMPT)
+    analysis['risk_score'] = round(sum(scores) / len(scores)) if scores else 0
+    analysis['critical_alerts'] = alerts
+    return analysis
+
+def needs_escalation(analysis):
+    """True when the triage result has HIGH alerts or a score below ESCALATION_SCORE"""
+    score = analysis.get('risk_score')
+    has_high_risk = any(
+        isinstance(alert, dict) and alert.get('severity') == "HIGH"
+        for alert in analysis.get('critical_alerts', [])
+    )
+    return has_high_risk or not isinstance(score, (int, float)) or score < ESCALATION_SCORE
+
+def request_analysis(text, on_field=None, on_item=None, on_escalate=None):
+    """
+    Sends the contract in one streamed call, or map-reduces it if it would overflow the context window.
+    Single-call results that look risky are re-analyzed by ESCALATION_MODEL_NAME, on top of
+    the triage call (higher cost than flash-lite alone, in exchange for a stronger review);
+    on_escalate is called first so the caller can reset any live preview.
+    """
+    if estimate_tokens(text) > LONG_CONTEXT_TOKEN_LIMIT:
+        return map_reduce_analysis(text, on_item=on_item)
+
+    contents = f"CONTRACT TEXT:\n{text}"
+    analysis = stream_generate(contents, on_field=on_field, on_item=on_item)
+    if not needs_escalation(analysis):
+        return analysis
+
+    if on_escalate:
+        on_escalate()
+    try:
+        return stream_generate(contents, on_field=on_field, on_item=on_item, model=ESCALATION_MODEL_NAME)
+    except (AnalysisError, requests.RequestException):
+        # Bad status, reset or timeout mid-stream: the triage report is still
+        # complete, which is better than failing the whole upload. It is flagged
+        # so it is only cached briefly and escalation is retried later.
+        analysis['escalation_failed'] = True
+        return analysis
+
+def analysis_cache_key(digest):
+    """Deterministic key: contract hash + model + prompt version"""
+    return f"{digest}:{MODEL_NAME}+{ESCALATION_MODEL_NAME}:{PROMPT_VERSION}"
+
+class AnalysisCache:
+    """
+    Thread-safe LRU of finished analyses shared by all sessions.
+    Kept manual (instead of st.cache_data) so a cache miss can stream into the UI.
+    Entries may carry their own, shorter, TTL.
+    """
+    def __init__(self, ttl=86400, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, analysis = entry
+            if time.time() > expires_at:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return analysis
+
+    def set(self, key, analysis, ttl=None):
+        with self.lock:
+            self.entries[key] = (time.time() + (self.ttl if ttl is None else ttl), analysis)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+@st.cache_resource
+def get_analysis_cache():
+    return AnalysisCache()
+
+# OCR is the slowest step, so its text is cached under the same upload hash
+@st.cache_resource
+def get_ocr_cache():
+    return AnalysisCache(max_entries=64)
+
+def ocr_contract(file_hash, stream):
+    """OCR fallback for scanned PDFs; returns '' when OCR is not installed or fails"""
+    cache = get_ocr_cache()
+    text = cache.get(file_hash)
+    if text is not None:
+        return text
+    if not ocr_available():
+        return ""
+    try:
+        stream.seek(0)
+        text = normalize_whitespace(ocr_pdf_text(stream))
+    except Exception:
+        return ""
+    cache.set(file_hash, text)
+    return text
+
+# Triage-only fallbacks (pro call failed, often a 429) expire quickly so the contract gets re-checked
+DEGRADED_CACHE_TTL = 600
+
+def analyze_contract(text, file_hash=None, on_field=None, on_item=None, on_escalate=None):
+    """
+    Returns the analysis for this contract, reusing a cached result for repeat uploads.
+    file_hash is the sha256 of the uploaded bytes; the text is hashed if it is missing.
+    On a cache miss, on_field/on_item receive partial results while Gemini streams,
+    and on_escalate fires if the contract is re-run on the stronger model.
+    """
+    cache = get_analysis_cache()
+    digest = file_hash or hashlib.sha256(text.encode("utf-8")).hexdigest()
+    cache_key = analysis_cache_key(digest)
+    analysis = cache.get(cache_key)
+    if analysis is not None:
+        return analysis
+
+    try:
+        analysis = request_analysis(text, on_field=on_field, on_item=on_item, on_escalate=on_escalate)
+    except AnalysisError as e:
+        st.error(str(e))
+        return None
     except Exception as e:
         st.error(f"Analysis Failed: {e}")
         return None
 
+    cache.set(cache_key, analysis, ttl=DEGRADED_CACHE_TTL if analysis.get('escalation_failed') else None)
+    return analysis
+
+def process_upload(filename, file_hash, stream):
+    """Extracts and analyzes one upload with a live preview; returns (contract_text, analysis)"""
+    with st.spinner("⏳ در حال استخراج متن و آنالیز با مدل جدید..."):
+        contract_text = extract_text(filename, stream)
+
+        # Scanned PDFs have no text layer: OCR them rather than asking for another upload
+        if len(contract_text.strip()) < 10 and filename.endswith('.pdf'):
+            contract_text = ocr_contract(file_hash, stream)
+
+        if len(contract_text) < 10:
+            st.warning("متن کافی استخراج نشد.")
+            return contract_text, None
+
+        # Live preview painted while Gemini streams; replaced by the full report
+        live = st.empty()
+        live_box = live.container()
+
+        def show_field(key, value):
+            if key == 'summary':
+                live_box.info(f"💡 **خلاصه:** {value}")
+            elif key == 'risk_score':
+                live_box.markdown(f"### امتیاز ریسک: {value}/100")
+
+        def show_item(key, item):
+            if key == 'critical_alerts' and isinstance(item, dict):
+                icon = "⛔" if item.get('severity') == "HIGH" else "⚠️"
+                live_box.markdown(f"{icon} {item.get('risk_explanation')}")
+
+        def restart_preview():
+            # The stronger model streams a fresh report; start the preview over
+            nonlocal live_box
+            live_box = live.container()
+            live_box.caption("🔍 ریسک بالا شناسایی شد؛ بررسی دقیق‌تر با مدل قوی‌تر...")
+
+        analysis = analyze_contract(
+            contract_text,
+            file_hash=file_hash,
+            on_field=show_field,
+            on_item=show_item,
+            on_escalate=restart_preview
+        )
+        live.empty()
+    return contract_text, analysis
+
 # --- UI LAYOUT ---
 st.title("🇮🇷 دستیار هوشمند بررسی قرارداد (MVP)")
 st.markdown("""
-این سیستم با استفاده از **Gemini 2.5 Flash Lite** قرارداد شما را بررسی می‌کند.
+این سیستم با استفاده از **Gemini 2.5 Flash Lite** قرارداد شما را بررسی می‌کند
+و در صورت یافتن ریسک بالا، آن را با **Gemini 2.5 Pro** دوباره بررسی می‌کند.
 فایل PDF یا متن قرارداد را آپلود کنید.
 """)
 
 uploaded_file = st.file_uploader("آپلود فایل قرارداد", type=["pdf", "txt"])
 
 if uploaded_file:
-    with st.spinner("⏳ در حال استخراج متن و آنالیز با مدل جدید..."):
-        # 1. Extract Text
-        contract_text = extract_text(uploaded_file)
-        
-        # 2. Analyze
-        if len(contract_text) < 10:
-            st.warning("متن کافی استخراج نشد.")
-        else:
-            analysis = analyze_contract(contract_text)
-            
+    # 1. Reruns (any widget interaction) keep the same file_id, so the upload is
+    #    not even re-hashed; a new upload with identical bytes reuses the analysis by hash
+    #    A triage-only fallback is shown but never pinned, so a later rerun retries escalation
+    show_report = st.session_state.get('last_file_id') == uploaded_file.file_id
+    if not show_report:
+        file_hash = hash_upload(uploaded_file)
+        stored = st.session_state.get('last_hash') == file_hash
+        if not stored or st.session_state['analysis'].get('escalation_failed'):
+            contract_text, analysis = process_upload(uploaded_file.name, file_hash, uploaded_file)
             if analysis:
-                st.divider()
-                # Report Dashboard
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    score = analysis.get('risk_score', 0)
-                    color = "green" if score >= 80 else "orange" if score >= 50 else "red"
-                    st.markdown(f"### امتیاز ریسک: :{color}[{score}/100]")
-                with col2:
-                    st.markdown(f"**نوع:** {analysis.get('contract_type', 'نامشخص')}")
-                with col3:
-                    st.markdown(f"**مدت:** {analysis.get('duration', 'نامشخص')}")
-
-                st.info(f"💡 **خلاصه:** {analysis.get('summary')}")
-
-                st.subheader("🚩 ریسک‌های شناسایی شده")
-                alerts = analysis.get('critical_alerts', [])
-                if not alerts:
-                    st.success("ریسک بزرگی پیدا نشد.")
-                
-                for alert in alerts:
-                    icon = "⛔" if alert.get('severity') == "HIGH" else "⚠️"
-                    with st.expander(f"{icon} {alert.get('risk_explanation')[:60]}...", expanded=True):
-                        c1, c2 = st.columns([2, 1])
-                        with c1:
-                            st.markdown(f"**بند:** `{alert.get('clause_text')}`")
-                            st.markdown(f"**تحلیل:** {alert.get('risk_explanation')}")
-                        with c2:
-                            st.markdown(f"**اصطلاح:** `{alert.get('legal_term')}`")
-                            st.markdown(f"💡 **پیشنهاد:** {alert.get('suggestion')}")
-
-                if analysis.get('missing_clauses'):
-                    st.warning(f"**بندهای جامانده:** {', '.join(analysis['missing_clauses'])}")
-
-                with st.expander("مشاهده متن خام"):
-                    st.text(contract_text)
\ No newline at end of file
+                st.session_state['last_hash'] = file_hash
+                st.session_state['contract_text'] = contract_text
+                st.session_state['analysis'] = analysis
+        show_report = st.session_state.get('last_hash') == file_hash
+        if show_report and not st.session_state['analysis'].get('escalation_failed'):
+            st.session_state['last_file_id'] = uploaded_file.file_id
+
+    # 2. Render from session state so UI reruns never recompute anything
+    if show_report:
+        analysis = st.session_state['analysis']
+        contract_text = st.session_state['contract_text']
+
+        st.divider()
+        # Report Dashboard
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            score = analysis.get('risk_score', 0)
+            color = "green" if score >= 80 else "orange" if score >= 50 else "red"
+            st.markdown(f"### امتیاز ریسک: :{color}[{score}/100]")
+        with col2:
+            st.markdown(f"**نوع:** {analysis.get('contract_type', 'نامشخص')}")
+        with col3:
+            st.markdown(f"**مدت:** {analysis.get('duration', 'نامشخص')}")
+
+        st.info(f"💡 **خلاصه:** {analysis.get('summary')}")
+        if analysis.get('escalation_failed'):
+            st.caption("⚠️ بررسی تکمیلی با مدل قوی‌تر انجام نشد؛ این گزارش از مدل سریع است و بعداً دوباره بررسی می‌شود.")
+
+        st.subheader("🚩 ریسک‌های شناسایی شده")
+        alerts = analysis.get('critical_alerts', [])
+        if not alerts:
+            st.success("ریسک بزرگی پیدا نشد.")
+        else:
+            # One markdown message for all alerts instead of an expander + columns each
+            st.markdown(render_alerts_html(alerts), unsafe_allow_html=True)
+
+        if analysis.get('missing_clauses'):
+            st.warning(f"**بندهای جامانده:** {', '.join(analysis['missing_clauses'])}")
+
+        with st.expander("مشاهده متن خام"):
+            st.text(contract_text)
\ No newline at end of file
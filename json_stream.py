@@ -0,0 +1,160 @@
+"""
+Tolerant O(n) streaming parser for the model's JSON analysis.
+Kept outside app.py so it can be imported (and its doctests run with
+`python -m doctest json_stream.py`) without starting Streamlit.
+
+>>> fields, items = [], []
+>>> parser = IncrementalJSONParser(
+...     on_field=lambda key, value: fields.append(key),
+...     on_item=lambda key, item: items.append(item))
+>>> for chunk in ['Sure:\\n```json\\n{"summary": "a \\\\"}\\\\" b", "critical_', 'alerts": [{"n": 1}, ', '{"n": 2}]}\\n```']:
+...     parser.feed(chunk)
+>>> fields
+['summary', 'critical_alerts']
+>>> items
+[{'n': 1}, {'n': 2}]
+>>> parser.result()['summary']
+'a "}" b'
+
+Truncated output never produces a result:
+
+>>> parser = IncrementalJSONParser()
+>>> parser.feed('{"summary": "cut off')
+>>> parser.result()
+Traceback (most recent call last):
+...
+ValueError: response ended before the JSON object closed
+"""
+import json
+
+# orjson parses UTF-8 bytes natively and is much faster on Farsi-heavy JSON;
+# both raise ValueError subclasses, so callers work with either
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+
+class IncrementalJSONParser:
+    """
+    Each fed character is scanned once. Calls on_field(key, value) as soon as a
+    top-level member is complete, and on_item(key, item) for every finished
+    element of a top-level array (e.g. each critical_alerts entry).
+    Anything before the first '{' (stray prose, code fences) is ignored.
+    Chunks are kept in lists and joined once, so there is no O(n^2) string +=.
+    """
+    def __init__(self, on_field=None, on_item=None):
+        self.on_field = on_field
+        self.on_item = on_item
+        self.chunks = []
+        self._text = None
+        self.offset = 0
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.done = False
+        self.start = None
+        self.end = None
+        # Pieces of the current top-level member / array item (None when not inside one)
+        self.member = None
+        self.item = None
+        self.array_key = None
+
+    @property
+    def buffer(self):
+        """All text fed so far"""
+        if self._text is None:
+            self._text = "".join(self.chunks)
+        return self._text
+
+    def feed(self, chunk):
+        self.chunks.append(chunk)
+        self._text = None
+        member_from = 0 if self.member is not None else None
+        item_from = 0 if self.item is not None else None
+
+        for i, ch in enumerate(chunk):
+            if self.done:
+                break
+            depth = len(self.stack)
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif depth == 0:
+                if ch == "{":
+                    self.stack.append(ch)
+                    self.start = self.offset + i
+                    self.member, member_from = [], i + 1
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                if depth == 1 and ch == "[":
+                    self.array_key = self._member_key(self._take(self.member, chunk, member_from, i))
+                    self.item, item_from = [], i + 1
+                self.stack.append(ch)
+            elif ch in "}]":
+                if depth == 2 and self.stack[-1] == "[":
+                    self._emit_item(self._take(self.item, chunk, item_from, i))
+                    self.item, item_from = None, None
+                self.stack.pop()
+                if depth == 1:
+                    self._emit_field(self._take(self.member, chunk, member_from, i))
+                    self.member, member_from = None, None
+                    self.end = self.offset + i + 1
+                    self.done = True
+            elif ch == ",":
+                if depth == 1:
+                    self._emit_field(self._take(self.member, chunk, member_from, i))
+                    self.member, member_from = [], i + 1
+                elif depth == 2 and self.stack[-1] == "[":
+                    self._emit_item(self._take(self.item, chunk, item_from, i))
+                    self.item, item_from = [], i + 1
+
+        # Carry the unfinished member/item over to the next chunk
+        if member_from is not None:
+            self.member.append(chunk[member_from:])
+        if item_from is not None:
+            self.item.append(chunk[item_from:])
+        self.offset += len(chunk)
+
+    @staticmethod
+    def _take(pieces, chunk, start, stop):
+        return "".join(pieces) + chunk[start:stop]
+
+    def result(self):
+        """
+        Parses the outermost {...} found so far, ignoring any prose or code
+        fences around it. Raises ValueError if the object never closed.
+        """
+        if not self.done:
+            raise ValueError("response ended before the JSON object closed")
+        return json_loads(self.buffer[self.start:self.end])
+
+    @staticmethod
+    def _member_key(prefix):
+        try:
+            return json_loads(prefix.strip().rstrip(":").strip())
+        except ValueError:
+            return None
+
+    def _emit_field(self, member):
+        if not member.strip() or not self.on_field:
+            return
+        try:
+            (key, value), = json_loads("{" + member + "}").items()
+        except ValueError:
+            return
+        self.on_field(key, value)
+
+    def _emit_item(self, item):
+        if not item.strip() or not self.on_item:
+            return
+        try:
+            value = json_loads(item)
+        except ValueError:
+            return
+        self.on_item(self.array_key, value)
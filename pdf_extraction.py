@@ -0,0 +1,123 @@
+"""
+PDF text extraction. Uses MuPDF (native code) when installed; falls back to
+pypdf, parallelised by document size, for files MuPDF rejects.
+Scanned PDFs without a text layer can be OCR'd with Tesseract.
+Kept outside app.py so process-pool workers can import it (the Streamlit
+script itself cannot be pickled).
+"""
+import io
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import pypdf
+
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+try:
+    import pytesseract
+    from PIL import Image
+except ImportError:
+    pytesseract = None
+
+# Below this many pages the process start-up costs more than it saves
+SEQUENTIAL_MAX_PAGES = 10
+OCR_DPI = 200
+OCR_LANG = "fas"
+# A 200 dpi A4 page is ~11.6 MB of RGB; only this many are held at once
+OCR_MAX_IN_FLIGHT = 4
+
+
+def _page_text(page):
+    return page.extract_text() or ""
+
+
+def _extract_page_range(data, start, stop):
+    """Worker: reopens the PDF from bytes so no page objects are pickled"""
+    reader = pypdf.PdfReader(io.BytesIO(data), strict=False)
+    return [_page_text(reader.pages[i]) for i in range(start, stop)]
+
+
+def extract_pdf_text(stream):
+    """Returns the text of every page in the PDF file-like object"""
+    if pymupdf is not None:
+        try:
+            return _extract_with_pymupdf(stream)
+        except Exception:
+            # MuPDF refused the file; pypdf is more lenient with some broken PDFs
+            stream.seek(0)
+    return _extract_with_pypdf(stream)
+
+
+def _extract_with_pymupdf(stream):
+    # One native get_text call per page; fast enough that no pool is needed
+    # (MuPDF documents are also not safe to share across threads)
+    with pymupdf.open(stream=stream.read(), filetype="pdf") as doc:
+        return "\n".join(page.get_text("text") for page in doc)
+
+
+def _extract_with_pypdf(stream):
+    reader = pypdf.PdfReader(stream, strict=False)
+    page_count = len(reader.pages)
+    workers = min(os.cpu_count() or 1, page_count)
+
+    # Collect page texts in a list and join once (avoids O(n^2) string +=)
+    if page_count <= SEQUENTIAL_MAX_PAGES or workers == 1:
+        parts = [_page_text(page) for page in reader.pages]
+    else:
+        # Contiguous page batches, one per worker, so results come back in order
+        stream.seek(0)
+        data = stream.read()
+        batch_size = -(-page_count // workers)
+        starts = range(0, page_count, batch_size)
+        stops = [min(start + batch_size, page_count) for start in starts]
+
+        # spawn, not fork: forking the multi-threaded Streamlit server can deadlock
+        # on locks held by other threads. Workers only need this module importable.
+        spawn = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=spawn) as pool:
+            batches = pool.map(_extract_page_range, [data] * len(starts), starts, stops)
+            parts = [text for batch in batches for text in batch]
+    return "\n".join(parts)
+
+
+def ocr_available():
+    """OCR needs pymupdf (to rasterise), pytesseract and the tesseract binary"""
+    if pymupdf is None or pytesseract is None:
+        return False
+    try:
+        pytesseract.get_tesseract_version()
+    except Exception:
+        return False
+    return True
+
+
+def _ocr_image(image):
+    return pytesseract.image_to_string(image, lang=OCR_LANG)
+
+
+def ocr_pdf_text(stream):
+    """Returns OCR text for every page of a scanned PDF"""
+    # Pages are rasterised lazily on this thread (MuPDF documents are not
+    # thread-safe) and OCR'd on a small pool: tesseract runs as a subprocess,
+    # so threads scale. Rendering pauses while OCR_MAX_IN_FLIGHT pages are
+    # pending, keeping memory bounded regardless of page count.
+    workers = min(os.cpu_count() or 1, OCR_MAX_IN_FLIGHT)
+    futures = []
+    pending = set()
+    with pymupdf.open(stream=stream.read(), filetype="pdf") as doc, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        for page in doc:
+            if len(pending) >= workers:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            pix = page.get_pixmap(dpi=OCR_DPI)
+            image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            del pix
+            future = pool.submit(_ocr_image, image)
+            del image
+            futures.append(future)
+            pending.add(future)
+        return "\n".join(future.result() for future in futures)